@@ -0,0 +1,87 @@
+from typing import Optional
+from pathlib import Path
+from contextlib import closing
+import sqlite3
+import os
+import fcntl
+import time
+
+
+# Least-recently-used cache of downloaded blobs on the local disk. The files are keyed 
+# by blob name and generation, so that a changed blob is never served from the cache.
+# Sizes and access times are tracked in a sqlite index next to the files, which can be
+# shared by several workers on the same machine.
+class DiskCache:
+    def __init__(self, path: Path, max_size_gb: float = 10.0) -> None:
+        self.path = Path(path)
+        self.max_size = int(max_size_gb * 1024 ** 3)
+
+        # create the cache directory and the index
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con, con:
+            con.execute("create table if not exists files (name text primary key, size integer, atime real)")
+
+    def _connect(self):
+        # use a new connection for every operation, as the cache is used from different threads
+        return closing(sqlite3.connect(self.path / 'index.sqlite', timeout=30))
+
+    def file(self, blob_name: str, generation: int) -> Path:
+        return self.path / f"{blob_name}.{generation}"
+
+    def partial(self, blob_name: str, generation: int) -> Path:
+        # downloads are written to a partial file first, which is kept to resume the download
+        path = self.file(blob_name, generation)
+        return path.with_name(f"{path.name}.part")
+
+    def remove_partials(self, blob_name: str, generation: int) -> None:
+        # partial files are not in the index, so the ones of older generations are removed here.
+        # Files that are locked are still downloaded by another worker and are left alone
+        keep = self.partial(blob_name, generation)
+        prefix = f"{Path(blob_name).name}."
+        if not keep.parent.exists():
+            return
+        for entry in os.scandir(keep.parent):
+            if entry.name == keep.name or not entry.name.startswith(prefix) or not entry.name.endswith('.part'):
+                continue
+            if not entry.name[len(prefix):-len('.part')].isdigit():
+                continue
+            with open(entry.path, 'ab') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                os.remove(entry.path)
+
+    def get(self, blob_name: str, generation: int, size: Optional[int] = None) -> Optional[Path]:
+        # only files in the index are complete, a crashed download may have left a partial file
+        path = self.file(blob_name, generation)
+        with self._connect() as con, con:
+            found = con.execute("update files set atime = ? where name = ?", (time.time(), str(path))).rowcount > 0
+
+        # if the size of the blob is known, a truncated file is not used either
+        if found and path.exists() and (size is None or path.stat().st_size == size):
+            return path
+        return None
+
+    def add(self, blob_name: str, generation: int) -> Path:
+        # register the completely downloaded file
+        path = self.file(blob_name, generation)
+        with self._connect() as con, con:
+            con.execute("insert or replace into files values (?, ?, ?)", (str(path), path.stat().st_size, time.time()))
+
+        # evict the least recently used files, if the cache grew too large
+        self.evict(keep=path)
+
+        return path
+
+    def evict(self, keep: Optional[Path] = None) -> None:
+        with self._connect() as con, con:
+            total = con.execute("select coalesce(sum(size), 0) from files").fetchone()[0]
+            for name, size in con.execute("select name, size from files order by atime asc").fetchall():
+                if total <= self.max_size:
+                    break
+                if keep is not None and name == str(keep):
+                    continue
+                con.execute("delete from files where name = ?", (name,))
+                Path(name).unlink(missing_ok=True)
+                total -= size
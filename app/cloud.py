@@ -1,41 +1,250 @@
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Dict, Tuple, Set, Callable, NamedTuple
 from typing_extensions import Literal
 import json
 from io import BytesIO, IOBase
-from functools import cached_property
+from functools import cached_property, lru_cache
 from contextlib import contextmanager
 from pathlib import Path
+from uuid import uuid4
+import os
+import fcntl
+import shutil
+import gzip
+import time
+import random
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from dotenv import load_dotenv
-from pydantic import Field, computed_field, BaseModel
+from pydantic import Field, PrivateAttr, computed_field, BaseModel
 from pydantic_settings import BaseSettings
-from google.cloud.storage import Client, Bucket
+from google.api_core.exceptions import NotFound, PreconditionFailed, from_http_response
+from google.cloud.storage import Client, Bucket, Blob, transfer_manager
 from google.oauth2 import service_account
+from google.resumable_media import DataCorruption
+import google_crc32c
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .cache import DiskCache
 
 load_dotenv()
 
 
+@lru_cache(maxsize=8)
+def storage_client(project_id: str, gkey: str) -> Client:
+    # the client is shared by all Processors and threads of a process, so that credentials
+    # and connections are set up only once. Build credentials from the service account
+    credentials = service_account.Credentials.from_service_account_file(gkey)
+
+    # initialize the client
+    client = Client(project_id, credentials=credentials)
+
+    # use a larger connection pool, so that parallel up- and downloads reuse their connections,
+    # and retry transient errors. The last response is returned to the client, to handle its status.
+    # The pool has to be at least as large as the largest thread pool of the Processor (upload_many),
+    # otherwise the threads wait for free connections. http is mounted as well, for storage emulators
+    retries = Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64, max_retries=retries)
+    client._http.mount('https://', adapter)
+    client._http.mount('http://', adapter)
+
+    return client
+
+
+@lru_cache(maxsize=32)
+def storage_bucket(project_id: str, gkey: str, name: str) -> Bucket:
+    # buckets are shared like the client, so that all Processors of a process use the same objects
+    return storage_client(project_id, gkey).bucket(name)
+
+
+def file_crc32c(path: Path, chunk_size: int = 8 * 1024 * 1024) -> str:
+    # the crc32c checksum of a file, encoded like the crc32c of a blob
+    checksum = google_crc32c.Checksum()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+
+def drop_page_cache(f: IOBase) -> None:
+    # files that are read much later, or by another process, should not push other pages
+    # out of the page cache. Only written pages can be dropped, so sync first
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    f.flush()
+    os.fdatasync(f.fileno())
+    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+class CachedLog(NamedTuple):
+    generation: int
+    size: int
+    # the last bytes of the stored gzip data, to recognize that the log was only appended to
+    tail: bytes
+    content: Set[str]
+
+
 class LogHandler(BaseModel):
     processor: 'Processor'
     log_file: str
+    max_retries: int = 5
+    max_components: int = 1000
+    backoff: float = 0.5
+
+    def _load(self) -> Tuple[int, Set[str]]:
+        blob = self.processor.target.blob(self.log_file)
+        for attempt in range(self.max_retries):
+            # reload only the metadata of the log file, to learn the current generation
+            try:
+                blob.reload()
+            except NotFound:
+                # generation 0 is the precondition for 'the log does not exist yet'
+                self.processor._log_cache.pop(self.log_file, None)
+                return 0, set()
+
+            # if the log did not change since we last downloaded it, use the cached content
+            cached = self.processor._log_cache.get(self.log_file)
+            if cached is not None and cached.generation == blob.generation:
+                return cached.generation, cached.content
+            
+            # otherwise download exactly the generation we just learned about
+            is_gzip = blob.content_encoding == 'gzip'
+            try:
+                # if the log grew, try to download only the appended lines
+                appended = None
+                if is_gzip and cached is not None and len(cached.tail) > 0 and blob.size > cached.size:
+                    appended = self._download_appended(blob, cached)
+                
+                if appended is not None:
+                    data = appended
+                    content = cached.content | self._parse(appended, is_gzip=True)
+                else:
+                    data = blob.download_as_bytes(raw_download=True, if_generation_match=blob.generation)
+                    content = self._parse(data, is_gzip=is_gzip)
+            except PreconditionFailed:
+                # the log changed in between, try again
+                self._wait(attempt)
+                continue
+            
+            self.processor._log_cache[self.log_file] = CachedLog(blob.generation, blob.size, data[-8:] if is_gzip else b'', content)
+            return blob.generation, content
+
+        raise RuntimeError(f'Could not read log {self.log_file}, it changed {self.max_retries} times while reading.')
+
+    def _wait(self, attempt: int) -> None:
+        # wait an exponentially growing, random time before the next attempt, so that workers
+        # writing the same log do not collide again. GCS allows about one write per second per object
+        if attempt + 1 < self.max_retries:
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _download_appended(self, blob: Blob, cached: CachedLog) -> Optional[bytes]:
+        # appends compose new gzip members onto the log, so the cached bytes stay the prefix of the log.
+        # download from the last known bytes on, which also tells if the log was rewritten in the meantime
+        start = cached.size - len(cached.tail)
+        data = blob.download_as_bytes(start=start, raw_download=True, if_generation_match=blob.generation, checksum=None)
+        if not data.startswith(cached.tail):
+            return None
+        
+        # return only the appended gzip members
+        return data[len(cached.tail):]
+
+    def _parse(self, data: bytes, is_gzip: bool) -> Set[str]:
+        # appended parts are separate gzip members, which gzip decompresses as one stream
+        if is_gzip:
+            data = gzip.decompress(data)
+        return set(line for line in data.decode('utf-8').split('\n') if line != '')
+
+    def _update(self, func: Callable[[Set[str]], None]) -> None:
+        blob = self.processor.target.blob(self.log_file)
+        for attempt in range(self.max_retries):
+            # apply the change to a copy of the current content, the cache is only updated on success
+            generation, content = self._load()
+            new_content = set(content)
+            func(new_content)
+
+            # only overwrite the log if no other worker changed it since we read it
+            try:
+                data = self._upload(blob, '\n'.join(new_content), if_generation_match=generation)
+            except PreconditionFailed:
+                self.processor._log_cache.pop(self.log_file, None)
+                self._wait(attempt)
+                continue
+
+            self.processor._log_cache[self.log_file] = CachedLog(blob.generation, len(data), data[-8:], new_content)
+            return
+        
+        raise RuntimeError(f'Could not update log {self.log_file}, it changed {self.max_retries} times while writing.')
+
+    def _upload(self, blob: Blob, text: str, if_generation_match: Optional[int] = None) -> bytes:
+        # logs are stored gzip compressed, GCS serves them decompressed to other clients
+        data = gzip.compress(text.encode('utf-8'))
+        blob.content_encoding = 'gzip'
+        blob.upload_from_string(data, content_type='text/plain', if_generation_match=if_generation_match)
+
+        return data
 
     @property
-    def _content(self):
-        if self.processor.target.blob(self.log_file).exists():
-            return self.processor.target.blob(self.log_file).download_as_string().decode('utf-8').split('\n')
-        else:
-            return []
+    def _content(self) -> Set[str]:
+        return self._load()[1]
         
     def add(self, item: str):
-        new_content = self._content + [item]
-        self.processor.target.blob(self.log_file).upload_from_string('\n'.join(new_content))
+        target = self.processor.target
+        for attempt in range(self.max_retries):
+            cached = self.processor._log_cache.get(self.log_file)
+            if cached is not None and len(cached.tail) > 0:
+                # a cached compressed log is appended to at its cached generation, a failed
+                # precondition will invalidate the cache and the metadata is requested below
+                generation = cached.generation
+            else:
+                # learn the current generation and encoding of the log
+                current = target.get_blob(self.log_file)
+                if current is not None and current.content_encoding != 'gzip':
+                    # logs written uncompressed can't be appended to, so they are rewritten once
+                    self._update(lambda content: content.add(item))
+                    return
+                generation = current.generation if current is not None else 0
+
+            log = target.blob(self.log_file)
+            try:
+                if generation == 0:
+                    # the log does not exist yet, create it
+                    data = self._upload(log, item, if_generation_match=0)
+                else:
+                    # upload only the new line and append it to the log on the server
+                    part = target.blob(f'{self.log_file}.part-{uuid4().hex}')
+                    data = self._upload(part, f'\n{item}')
+                    try:
+                        log.content_encoding = 'gzip'
+                        log.content_type = 'text/plain'
+                        log.compose([log, part], if_generation_match=generation)
+                    finally:
+                        part.delete()
+            except (PreconditionFailed, NotFound):
+                # another worker changed or removed the log in the meantime, try again
+                self.processor._log_cache.pop(self.log_file, None)
+                self._wait(attempt)
+                continue
+
+            # the cache is still valid if it held the generation we appended to
+            if generation == 0:
+                self.processor._log_cache[self.log_file] = CachedLog(log.generation, len(data), data[-8:], {item})
+            elif cached is not None and cached.generation == generation:
+                self.processor._log_cache[self.log_file] = CachedLog(log.generation, log.size, data[-8:], cached.content | {item})
+            
+            # compact the log into a single object from time to time
+            if log.component_count is not None and log.component_count > self.max_components:
+                self._update(lambda content: None)
+            return
+        
+        raise RuntimeError(f'Could not update log {self.log_file}, it changed {self.max_retries} times while writing.')
     
     def remove(self, item: str):
-        new_content = [line for line in self._content if line != item]
-        self.processor.target.blob(self.log_file).upload_from_string('\n'.join(new_content))
+        self._update(lambda content: content.discard(item))
     
     def tolist(self) -> List[str]:
-        return self._content
+        return list(self._content)
     
     def __contains__(self, item: str) -> bool:
         return item in self._content
@@ -61,25 +270,30 @@ class Processor(BaseSettings):
     progress_log: str = 'progress.log'
     finished_log: str = 'finished.log'
     errored_log: str = 'errored.log'
+    cache_dir: Optional[Path] = None
+    cache_size_gb: float = 10.0
+
+    # cache of the log file contents, keyed by log file name and validated by the blob generation
+    _log_cache: Dict[str, CachedLog] = PrivateAttr(default_factory=dict)
 
     @computed_field
     @cached_property
     def client(self) -> Client:
-        # build credentials from the service account
-        credentials = service_account.Credentials.from_service_account_file(self.gkey)
-
-        # initialize the client
-        return Client(self. project_id, credentials=credentials)
+        return storage_client(self.project_id, self.gkey)
 
-    @computed_field
-    @property
+    @cached_property
     def source(self) -> Bucket:
-        return self.client.bucket(self.source_bucket)
+        return storage_bucket(self.project_id, self.gkey, self.source_bucket)
     
-    @computed_field
-    @property
+    @cached_property
     def target(self) -> Bucket:
-        return self.client.bucket(self.target_bucket)
+        return storage_bucket(self.project_id, self.gkey, self.target_bucket)
+
+    @cached_property
+    def cache(self) -> Optional[DiskCache]:
+        if self.cache_dir is None:
+            return None
+        return DiskCache(self.cache_dir, max_size_gb=self.cache_size_gb)
 
     @property
     def progress_list(self) -> LogHandler:
@@ -93,63 +307,250 @@ class Processor(BaseSettings):
     def errored_list(self) -> LogHandler:
         return LogHandler(processor=self, log_file=self.errored_log)
     
-    def next_file(self, prefix: Optional[str] = None) -> str:
-        # loop through all files of given prefix
-        for blob in self.source.list_blobs(prefix=prefix):
-            # check if the file is currently being processed
-            if blob.name in self.progress_list:
-                continue
+    def next_file(self, prefix: Optional[str] = None, exclude: Optional[Set[str]] = None) -> str:
+        # load the logs only once, instead of once per listed blob
+        skip = self.progress_list._content | self.finished_list._content | self.errored_list._content
 
-            # check if the file has already been processed
-            if blob.name in self.finished_list:
-                continue
+        # skip files the caller has reserved, but not yet logged
+        if exclude is not None:
+            skip = skip | exclude
 
-            # check if the file has already errored
-            if blob.name in self.errored_list:
-                continue
+        # list only the blob names, page by page, so that we can stop listing on the first match
+        blobs = self.client.list_blobs(self.source_bucket, prefix=prefix, fields='items(name),nextPageToken', page_size=100)
+        for page in blobs.pages:
+            for blob in page:
+                # skip files that are currently processed, have been processed, have errored or are excluded
+                if blob.name in skip:
+                    continue
 
-            # otherwie return the file name and break the loop
-            return blob.name
+                # otherwie return the file name and break the loop
+                return blob.name
 
-    def download(self, blob_name: str, target: Optional[IOBase] = None) -> IOBase:
-        # get the blob object
-        blob = self.source.blob(blob_name)
+    def _download_chunks(self, blob: Blob, target: IOBase, chunk_mb: int = 32, workers: int = 8) -> None:
+        # small blobs are downloaded in a single request
+        chunk_size = chunk_mb * 1024 * 1024
+        if blob.size <= chunk_size or workers <= 1:
+            blob.download_to_file(target, if_generation_match=blob.generation)
+            return
+        
+        # if the target is a new file on disk, the transfer manager streams the ranges into it in
+        # parallel and validates the crc32c checksum of the whole blob
+        target.flush()
+        offset = target.tell()
+        path = getattr(target, 'name', None)
+        if offset == 0 and isinstance(path, str) and os.path.isfile(path):
+            transfer_manager.download_chunks_concurrently(
+                blob,
+                path,
+                chunk_size=chunk_size,
+                download_kwargs={'if_generation_match': blob.generation},
+                worker_type=transfer_manager.THREAD,
+                max_workers=workers
+            )
+            target.seek(blob.size)
+            return
+
+        # other targets, like BytesIO, receive each range as a whole at its offset
+        lock = threading.Lock()
+
+        # ranges are not validated on their own, so the checksum of the whole blob is computed
+        # from the ranges in order, keeping only the ranges that arrived early
+        checksum = google_crc32c.Checksum()
+        pending = {}
+        checked = 0
 
-        # check if the blob exists
-        if not blob.exists():
+        def download_range(start: int) -> None:
+            nonlocal checked
+            end = min(start + chunk_size, blob.size) - 1
+            data = blob.download_as_bytes(start=start, end=end, if_generation_match=blob.generation, checksum=None)
+            with lock:
+                target.seek(offset + start)
+                target.write(data)
+
+                pending[start] = data
+                while checked in pending:
+                    data = pending.pop(checked)
+                    checksum.update(data)
+                    checked += len(data)
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(download_range, start) for start in range(0, blob.size, chunk_size)]
+            for future in futures:
+                future.result()
+        
+        crc32c = base64.b64encode(checksum.digest()).decode('utf-8')
+        if blob.crc32c is not None and crc32c != blob.crc32c:
+            raise DataCorruption(None, f'Checksum mismatch while downloading {blob.name}: expected crc32c {blob.crc32c}, got {crc32c}.')
+
+        # leave the target positioned after the blob, like download_to_file does
+        target.seek(offset + blob.size)
+
+    def download(self, blob_name: str, target: Optional[IOBase] = None, chunk_mb: int = 32, workers: int = 8) -> IOBase:
+        # get the blob object and its current generation
+        blob = self.source.blob(blob_name)
+        try:
+            blob.reload()
+        except NotFound:
             raise FileNotFoundError(f'Blob {blob_name} does not exist in bucket {self.source.path}.')
         
         # if no target is given, create a new BytesIO object
         if target is None:
             target = BytesIO()
         
-        # download the blob as bytes or text, depending on the target type
-        blob.download_to_file(target)
+        # without a cache, download the blob directly into the target
+        if self.cache is None:
+            self._download_chunks(blob, target, chunk_mb=chunk_mb, workers=workers)
+            return target
+        
+        # otherwise copy the cached file into the target
+        path = self._cached_file(blob, chunk_mb=chunk_mb, workers=workers)
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, target)
 
         return target
     
-    def upload(self, blob_name: str, source: Union[IOBase, str], if_exists: Union[Literal['raise'], Literal['ignore']] = 'raise') -> None:
+    def _cached_file(self, blob: Blob, chunk_mb: int = 32, workers: int = 8, drop_pages: bool = False) -> Path:
+        # use the cached file, if this generation was downloaded completely
+        path = self.cache.get(blob.name, blob.generation, size=blob.size)
+        if path is not None:
+            return path
+        
+        # otherwise download into a partial file, which is kept if the download is interrupted
+        path = self.cache.file(blob.name, blob.generation)
+        part = self.cache.partial(blob.name, blob.generation)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(part, 'ab') as f:
+            # only one worker on this machine downloads the file, the others wait for it
+            fcntl.flock(f, fcntl.LOCK_EX)
+            downloaded = f.seek(0, os.SEEK_END)
+            cached = self.cache.get(blob.name, blob.generation, size=blob.size)
+            if cached is not None:
+                if downloaded == 0:
+                    part.unlink(missing_ok=True)
+                return cached
+
+            # partial downloads of older generations of this blob can't be resumed anymore
+            self.cache.remove_partials(blob.name, blob.generation)
+
+            # resume an interrupted download of this generation from its last byte. Ranged downloads
+            # are not validated, so the checksum of the whole file is compared afterwards
+            complete = False
+            if 0 < downloaded <= blob.size:
+                if downloaded < blob.size:
+                    blob.download_to_file(f, start=downloaded, if_generation_match=blob.generation)
+                f.flush()
+                complete = blob.crc32c is None or file_crc32c(part) == blob.crc32c
+
+            # otherwise, or if the resumed file is corrupt, start over
+            if not complete:
+                f.truncate(0)
+                f.seek(0)
+                self._download_chunks(blob, f, chunk_mb=chunk_mb, workers=workers)
+
+            # files downloaded ahead of time are read much later, so their pages are not kept
+            if drop_pages:
+                drop_page_cache(f)
+            
+            # move the complete file into the cache, before the other workers are released
+            os.replace(part, path)
+            return self.cache.add(blob.name, blob.generation)
+
+    def fill_cache(self, prefix: str, workers: int = 16) -> None:
+        if self.cache is None:
+            raise RuntimeError('The download cache is not enabled, set cache_dir to fill it.')
+        
+        # list all blobs of the prefix, including their generation, size and checksum
+        blobs = [blob for blob in self.client.list_blobs(self.source_bucket, prefix=prefix, fields='items(name,generation,size,crc32c),nextPageToken') if not blob.name.endswith('/')]
+
+        # only fill the cache up to its size, as every further file would evict a file downloaded
+        # by this call. The files are filled in listing order, which is the processing order
+        fitting = []
+        total = 0
+        for blob in blobs:
+            if total + blob.size > self.cache.max_size:
+                break
+            fitting.append(blob)
+            total += blob.size
+
+        # download many files at once, each in a single request, as most of the time is spent waiting
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._cached_file, blob, workers=1, drop_pages=True) for blob in fitting]
+            for future in as_completed(futures):
+                future.result()
+
+    def upload(self, blob_name: str, source: Union[IOBase, str, bytes], if_exists: Union[Literal['raise'], Literal['ignore']] = 'raise') -> None:
         # get the blob object
         blob = self.target.blob(blob_name)
 
-        # check if the blob already exists
-        if blob.exists() and if_exists == 'raise':
+        # if the blob must not exist yet, let the bucket enforce that within the upload request
+        if_generation_match = 0 if if_exists == 'raise' else None
+
+        # upload the blob
+        try:
+            if isinstance(source, str):
+                blob.upload_from_filename(source, if_generation_match=if_generation_match)
+            elif isinstance(source, bytes):
+                blob.upload_from_string(source, if_generation_match=if_generation_match)
+            else:
+                # in-memory buffers are usually positioned at their end after writing to them
+                blob.upload_from_file(source, rewind=True, if_generation_match=if_generation_match)
+        except PreconditionFailed:
             raise FileExistsError(f'Blob {blob_name} already exists in bucket {self.target.path}.')
+
+    def upload_many(self, sources: Dict[str, Union[IOBase, str, bytes]], if_exists: Union[Literal['raise'], Literal['ignore']] = 'raise', workers: int = 32) -> None:
+        # in-memory sources are uploaded from their start, like in upload
+        pairs = []
+        for blob_name, source in sources.items():
+            if isinstance(source, bytes):
+                source = BytesIO(source)
+            elif not isinstance(source, str):
+                source.seek(0)
+            pairs.append((source, self.target.blob(blob_name)))
+
+        # upload many small blobs concurrently, threads are needed as file objects can't be sent to processes
+        upload_kwargs = {'if_generation_match': 0} if if_exists == 'raise' else None
+        results = transfer_manager.upload_many(pairs, upload_kwargs=upload_kwargs, worker_type=transfer_manager.THREAD, max_workers=workers)
+
+        # the transfer manager returns exceptions instead of raising them
+        for (_, blob), result in zip(pairs, results):
+            if isinstance(result, PreconditionFailed):
+                raise FileExistsError(f'Blob {blob.name} already exists in bucket {self.target.path}.')
+            if isinstance(result, Exception):
+                raise result
+
+    def batch_exists(self, blob_names: List[str], bucket: Union[Literal['source'], Literal['target']] = 'target') -> Dict[str, bool]:
+        # get the blob objects
+        bucket = self.source if bucket == 'source' else self.target
+        blobs = [bucket.blob(name) for name in blob_names]
+
+        # reload the metadata of up to 100 blobs in a single batch request
+        exists = {}
+        for i in range(0, len(blobs), 100):
+            with self.client.batch(raise_exception=False) as batch:
+                for blob in blobs[i:i + 100]:
+                    blob.reload()
+
+            # only a 404 means that the blob does not exist, any other error must not be taken as
+            # 'does not exist', as that would allow to overwrite the blob
+            for blob, response in zip(blobs[i:i + 100], batch._responses):
+                if response.status_code == 404:
+                    exists[blob.name] = False
+                elif not 200 <= response.status_code < 300:
+                    raise from_http_response(response)
+                else:
+                    exists[blob.name] = True
         
-        # otherwise upload the blob
-        if isinstance(source, str):
-            blob.upload_from_filename(source)
-        else:
-            blob.upload_from_file(source)
+        return exists
 
     @contextmanager
-    def unprocessed_file(self, file_name: Optional[str] = None, prefix: Optional[str] = None):
+    def unprocessed_file(self, file_name: Optional[str] = None, prefix: Optional[str] = None, reserved: bool = False):
         # get the next file to process
         if file_name is None:
             file_name = self.next_file(prefix=prefix)
 
-        # add the file name to the progress list
-        self.progress_list + file_name
+        # add the file name to the progress list, unless the caller already did so to reserve it
+        if not reserved:
+            self.progress_list + file_name
 
         # flag for errored files
         did_error = False
@@ -166,10 +567,11 @@ class Processor(BaseSettings):
 
             raise e
         finally:
-            # remove the file name from the progress list
-            self.progress_list - file_name
-
-            # add the file name to the finished list if no error occured
+            # add the file name to the finished list if no error occured - this is done before
+            # removing it from the progress list, so the file is never missing from both logs
             if not did_error:
                 self.finished_list + file_name
 
+            # remove the file name from the progress list
+            self.progress_list - file_name
+
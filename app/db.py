@@ -1,29 +1,55 @@
-from typing import Any, Optional, List, Generator
+from typing import Any, Optional, List, Generator, Tuple, Dict, Set
 from pathlib import Path
 import tempfile
-import io
+import glob
+import os
 from contextlib import contextmanager
+from collections import defaultdict
+from functools import lru_cache, cached_property
+import re
 
 from tqdm import tqdm
 import duckdb
 import geopandas as gpd
+from pyproj import Transformer
 import pandas as pd
 import rioxarray as rio
 import xarray as xr
 
 from .cloud import Processor
 
+# the extent of all catchments, which is queried once and passed to LOAD_SQL as parameters
+CATCHMENTS_BBOX_SQL = """select min(st_xmin(geom)), max(st_xmax(geom)), min(st_ymin(geom)), max(st_ymax(geom)) 
+from catchments;
+"""
+
+# the file name and variable are formatted in, as DuckDB can only scan a literal file name.
+# the bounding box is passed as parameters ($1 - $4) in the order of CATCHMENTS_BBOX_SQL
 LOAD_SQL = """create or replace table tmp as 
 select time, lon, lat, {variable} from '{fname}' 
 where {variable} is not null 
-and lon between (select st_xmin(geom) from catchments) and (select st_xmax(geom) from catchments)
-and lat between (select st_ymin(geom) from catchments) and (select st_ymax(geom) from catchments);
+and lon between $1 and $2
+and lat between $3 and $4;
 """
 
+# the year in HYRAS file names like 'tas_hyras_5_1951_v5-0_de.nc'
+YEAR_PATTERN = re.compile(r'_hyras_.*?(\d{4})')
+
+
+# local directory to keep the downloaded catchment files across processes, if no cache_dir is set
+CATCHMENTS_CACHE = Path.home() / '.cache' / 'clipper' / 'catchments'
+
+
+@lru_cache(maxsize=8)
+def read_catchments(path: str, where: Optional[str] = None) -> gpd.GeoDataFrame:
+    # the where clause is evaluated by the OGR driver, so filtered features are never parsed
+    return gpd.read_file(path, engine='pyogrio', where=where)
+
 
 class HyrasDBProcessor(Processor):
     catchments: str
     catchment_name: str = ''
+    catchments_where: Optional[str] = None
 
     def model_post_init(self, __context: Any) -> None:
         # we add the filename of the catchment geopackage to the processor logfiles 
@@ -38,32 +64,35 @@ class HyrasDBProcessor(Processor):
         
         return super().model_post_init(__context)
     
+    @cached_property
+    def files_by_year(self) -> Dict[int, Set[str]]:
+        # list all HYRAS files in a single listing and group them by year. The source files
+        # do not change during a run, so the listing is shared by all calls of next_year
+        by_year = defaultdict(set)
+        for blob in self.source.list_blobs(match_glob="*/*_hyras_*.nc", fields="items(name),nextPageToken"):
+            match = YEAR_PATTERN.search(blob.name)
+            if match is not None and 1950 <= int(match.group(1)) < 2024:
+                by_year[int(match.group(1))].add(blob.name)
+        return dict(by_year)
+
     def next_year(self) -> List[str]:
-        for year in range(1950, 2024):
-            # get all files for the currently tested year
-            blobs = list(self.source.list_blobs(match_glob=f"*/*_hyras_*{year}*.nc"))
+        by_year = self.files_by_year
 
-            # if there are none, continue to next year
-            if len(blobs) == 0:
-                continue
-            
-            # check if any of the files is currently being processed
-            progress = self.progress_list._content
-            if any([blob in progress for blob in blobs]):
-                continue
+        # load the logs once, they are only re-read after a year was handed out
+        skip = self.progress_list._content | self.finished_list._content | self.errored_list._content
 
-            # check if any of the files has already been processed
-            finished = self.finished_list._content
-            if any([blob in finished for blob in blobs]):
-                continue
+        for year in sorted(by_year.keys()):
+            names = by_year[year]
 
-            # check if any of the files has already errored
-            errored = self.errored_list._content
-            if any([blob in errored for blob in blobs]):
+            # check if any of the files is currently being processed, has already been processed or errored
+            if not skip.isdisjoint(names):
                 continue
 
             # if we are still here, yield the list of blobs
-            yield [blob.name for blob in blobs] 
+            yield sorted(names)
+
+            # the caller has processed the year in the meantime, so refresh the logs
+            skip = self.progress_list._content | self.finished_list._content | self.errored_list._content
 
 class HyrasDB:
     def __init__(self, processor: Optional[HyrasDBProcessor] = None) -> None:
@@ -75,19 +104,52 @@ class HyrasDB:
 
     def _load_catchments(self) -> None:
         # the file is in the target at the specified current location
-        blob = self.proc.target.blob(self.proc.catchments)
-
-        # load the file into a memory buffer
-        buffer = io.BytesIO()
-        blob.download_to_file(buffer)
-        buffer.seek(0)
-
-        # load using geopandas
-        self._catchments: gpd.GeoDataFrame = gpd.read_file(buffer)
+        blob = self.proc.target.get_blob(self.proc.catchments)
+        if blob is None:
+            raise FileNotFoundError(f'Blob {self.proc.catchments} does not exist in bucket {self.proc.target.path}.')
+
+        # download the file only once per machine and generation, next to the download cache if there is one
+        cache = self.proc.cache_dir / 'catchments' if self.proc.cache_dir is not None else CATCHMENTS_CACHE
+        name = Path(blob.name)
+        path = cache / self.proc.target_bucket / name.with_name(f"{name.stem}.{blob.generation}{name.suffix}")
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            # download next to the final path and move it there once complete, so that other
+            # workers on this machine never open a partially downloaded file
+            with tempfile.NamedTemporaryFile(dir=path.parent, suffix=path.suffix, delete=False) as tmp:
+                try:
+                    blob.download_to_file(tmp)
+                except Exception:
+                    # do not leave failed downloads behind in the cache directory
+                    os.remove(tmp.name)
+                    raise
+            os.replace(tmp.name, path)
+
+            # remove the files of older generations, other processes might still read them from open handles
+            for old in path.parent.glob(f"{glob.escape(name.stem)}.*{glob.escape(name.suffix)}"):
+                if old != path and old.name[len(name.stem) + 1:len(old.name) - len(name.suffix)].isdigit():
+                    old.unlink(missing_ok=True)
+
+        # load using geopandas, the parsed file is shared within the process
+        self._catchments: gpd.GeoDataFrame = read_catchments(str(path), where=self.proc.catchments_where).copy()
     
     @property
     def catchments(self) -> gpd.GeoDataFrame:
         if self._catchments is None:
             self._load_catchments()
         return self._catchments
-    
\ No newline at end of file
+    
+    def catchments_within(self, bounds: Tuple[float, float, float, float], crs: Any) -> gpd.GeoDataFrame:
+        # the bounds of a file, for example ds.rio.bounds() with ds.rio.crs, are usually given in
+        # another CRS than the catchments, so transform them first. The edges are densified, as they
+        # are not straight lines in the CRS of the catchments
+        if self.catchments.crs is None:
+            raise ValueError(f'The catchments {self.proc.catchments} have no CRS, the bounds cannot be transformed.')
+        transformer = Transformer.from_crs(crs, self.catchments.crs, always_xy=True)
+        bounds = transformer.transform_bounds(*bounds)
+
+        # use the spatial index to select only the catchments intersecting the bounds,
+        # so that clipping skips all other catchments
+        idx = self.catchments.sindex.intersection(bounds)
+        return self.catchments.iloc[sorted(idx)]
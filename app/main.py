@@ -1,7 +1,8 @@
-from typing import Optional
+from typing import Optional, Set, Tuple
 import os
 import time
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import xarray as xr
 import zonal_variograms.main as zv
@@ -19,6 +20,9 @@ VARIABLES = {
     'TemperatureMin': 'tasmin'
 }
 
+# the prefixes are processed one after another, if no prefix is given
+PREFIXES: Tuple[str, ...] = tuple(VARIABLES.keys())
+
 # instantiate a Processor object. That is populated with settings from an .env file, 
 # the envrionment variables, holds some defaults or can be overwritten by kwargs.
 # The Processor object is used to access the cloud storage buckets, and track the 
@@ -26,26 +30,55 @@ VARIABLES = {
 # between different containers, either in the google cloud or locally.
 # processor = Processor()
 
+def download_next_file(processor: Processor, prefix: str, handed_out: Set[str]) -> Tuple[Optional[str], Optional[str]]:
+    # get the next file name, that was not yet handed out by this worker
+    file_name = processor.next_file(prefix=prefix, exclude=handed_out)
+    if file_name is None:
+        return None, None
+    handed_out.add(file_name)
+
+    # reserve the file right away, so that other workers do not download it as well
+    processor.progress_list + file_name
+
+    # download into a temporary file, which is removed after processing
+    tmp = tempfile.NamedTemporaryFile(suffix='.nc', delete=False)
+    try:
+        with tmp:
+            processor.download(file_name, target=tmp)
+    except Exception:
+        # release the reservation, so that the file can be processed by another worker
+        os.remove(tmp.name)
+        processor.progress_list - file_name
+        raise
+    
+    return file_name, tmp.name
+
+
 def main(prefix: str = None, max_iterations: Optional[int] = None, timeout: Optional[int] = None):
     # check if there is an environment variable for the prefix
     if prefix is None:
         prefix = os.getenv('PREFIX')
     
-    # if prefix is None, recursively call main() with the first prefix in the VARIABLES dict
-    if prefix is None:
-        prefixes = list(VARIABLES.keys())
-        for prefix in prefixes:
-            main(prefix, int(max_iterations / len(prefixes)), int(timeout / len(prefixes)))
-    
-    # now there is a prefix for sure, so get the variable name from the VARIABLES dict
-    variable = VARIABLES[prefix]
-
     # check if there is an environment variable for the max_iterations
     if max_iterations is None:
         max_iterations = os.getenv('MAX_ITERATIONS')
     if max_iterations is not None:
         max_iterations = int(max_iterations)
 
+    # if prefix is None, recursively call main() for each prefix in the VARIABLES dict,
+    # splitting the iteration and time budget evenly, if there is one
+    if prefix is None:
+        for prefix in PREFIXES:
+            main(
+                prefix,
+                max_iterations // len(PREFIXES) if max_iterations is not None else None,
+                timeout / len(PREFIXES) if timeout is not None else None
+            )
+        return
+    
+    # now there is a prefix for sure, so get the variable name from the VARIABLES dict
+    variable = VARIABLES[prefix]
+
     # instaintiate a new Processor object
     processor = Processor()
 
@@ -53,39 +86,67 @@ def main(prefix: str = None, max_iterations: Optional[int] = None, timeout: Opti
     iteration = 0
     start = time.time()
 
-    # loop until the maximum number of iterations is reached
-    while iteration != max_iterations:
-        # check the timeout
-        if timeout is not None and time.time() - start > timeout:
-            # we have timed out, break the loop
-            break
-        
-        # get the next file to process, and write it to a temporary file
-        with tempfile.NamedTemporaryFile(suffix='.nc') as tmp:
-            # get the next file name to process - use the context manager to retrieve the filename
-            # as that will make Processor to track progress in logfiles, shared across all workers
-            with processor.next_unprocessed_file(prefix=prefix) as file_name:
+    # names of all files handed to this worker, so they are skipped even if a log is read from a stale cache
+    handed_out = set()
+
+    # download the next file in the background, while the current one is processed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # nothing is prefetched, if the budget does not allow a single iteration
+        upcoming = None
+        if max_iterations != 0:
+            upcoming = executor.submit(download_next_file, processor, prefix, handed_out)
+
+        try:
+            # loop until the maximum number of iterations is reached
+            while iteration != max_iterations:
+                # check the timeout
+                if timeout is not None and time.time() - start > timeout:
+                    # we have timed out, break the loop
+                    break
+            
+                # wait for the prefetched file
+                file_name, tmp_path = upcoming.result()
+                upcoming = None
+
                 # if the file_name is None, we have processed all files for this prefix
                 if file_name is None:
                     break
 
-                # otherwise, download to the temporary file
-                processor.download(file_name, target=tmp)
-
-                # open the temporary file as an xarray dataaset - this is special hyras handling
-                da = xr.open_dataset(tmp.name, decode_coords=True, mask_and_scale=True)[variable]
-
-                # for hyras we need to set the spatial reference system and the coordinates manually
-                # because the provider does somehow define the stuff differently, and GIS applications
-                # cannot open hyras properly
-                da.rio.set_spatial_dims(x_dim='x', y_dim='y', inplace=True)
-                da.rio.write_crs('epsg:3034', inplace=True)
-
-                # now turn back into a dataset
-                ds = xr.Dataset({variable: da})
-
-                # make the clip for all EZG, we can chunk this by hand using use_oid here
-                raise NotImplementedError('Not sure how to supply the EZG here') 
+                # start downloading the next file right away, if the budget allows another iteration
+                if iteration + 1 != max_iterations:
+                    upcoming = executor.submit(download_next_file, processor, prefix, handed_out)
+
+                try:
+                    # use the context manager for the prefetched file, as that will make Processor to 
+                    # track progress in logfiles, shared across all workers. The file is already reserved
+                    with processor.unprocessed_file(file_name=file_name, reserved=True):
+                        # open the temporary file as an xarray dataaset - this is special hyras handling
+                        # the file is opened lazily in chunks, so that clipping only reads the chunks it needs
+                        da = xr.open_dataset(tmp_path, engine='h5netcdf', chunks={'time': 365}, decode_coords=True, mask_and_scale=True)[variable]
+
+                        # for hyras we need to set the spatial reference system and the coordinates manually
+                        # because the provider does somehow define the stuff differently, and GIS applications
+                        # cannot open hyras properly
+                        da.rio.set_spatial_dims(x_dim='x', y_dim='y', inplace=True)
+                        da.rio.write_crs('epsg:3034', inplace=True)
+
+                        # now turn back into a dataset
+                        ds = xr.Dataset({variable: da})
+
+                        # make the clip for all EZG, we can chunk this by hand using use_oid here
+                        raise NotImplementedError('Not sure how to supply the EZG here') 
+                finally:
+                    os.remove(tmp_path)
+            
+                iteration += 1
+        finally:
+            # remove the file that was prefetched, but will not be processed anymore, and release
+            # its reservation. A failed prefetch has already cleaned up after itself
+            if upcoming is not None and upcoming.exception() is None:
+                file_name, tmp_path = upcoming.result()
+                if file_name is not None:
+                    os.remove(tmp_path)
+                    processor.progress_list - file_name
 
 
 if __name__ == '__main__':